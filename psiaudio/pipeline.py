@@ -1,9 +1,11 @@
 import logging
 log = logging.getLogger(__name__)
 
-from collections import deque
+from bisect import bisect_left
+from collections import deque, OrderedDict
 from copy import copy
-from threading import Event
+import itertools
+from threading import Event, Lock
 
 import numpy as np
 import pandas as pd
@@ -588,15 +590,102 @@ def blocked(block_size, target):
             n = merged.shape[-1]
 
 
+class _EpochPool:
+    '''
+    Pool of arrays used to hold captured epochs, keyed by (shape, dtype)
+
+    Epoch sizes within an experiment typically take on only a handful of
+    values, so reusing released arrays eliminates most allocations during
+    acquisition. To keep experiments with many distinct epoch sizes from
+    pinning memory, the pool is bounded both in the number of arrays kept per
+    (shape, dtype) and in the total number of bytes held. When full, arrays for
+    the least recently used (shape, dtype) are discarded first.
+    '''
+
+    def __init__(self, max_arrays, max_nbytes):
+        self.max_arrays = max_arrays
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self._pool = OrderedDict()
+        self._lock = Lock()
+
+    def acquire(self, shape, dtype):
+        key = shape, np.dtype(dtype)
+        with self._lock:
+            arrays = self._pool.get(key)
+            if arrays:
+                epoch = arrays.pop()
+                if arrays:
+                    self._pool.move_to_end(key)
+                else:
+                    del self._pool[key]
+                self.nbytes -= epoch.nbytes
+                return epoch
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, epoch):
+        if epoch.size == 0 or epoch.nbytes > self.max_nbytes:
+            return
+        key = epoch.shape, epoch.dtype
+        with self._lock:
+            # Only non-empty lists are kept in the pool, so there is always
+            # something to evict while nbytes is greater than zero.
+            arrays = self._pool.get(key, [])
+            if arrays:
+                self._pool.move_to_end(key)
+            if len(arrays) >= self.max_arrays:
+                return
+            while self.nbytes + epoch.nbytes > self.max_nbytes:
+                lru_key, lru_arrays = next(iter(self._pool.items()))
+                self.nbytes -= lru_arrays.pop().nbytes
+                if not lru_arrays:
+                    del self._pool[lru_key]
+            self._pool.setdefault(key, arrays).append(epoch)
+            self.nbytes += epoch.nbytes
+
+
+# Maximum number of released arrays to keep for each (shape, dtype) and
+# maximum total size of all arrays in the pool.
+EPOCH_POOL_SIZE = 64
+EPOCH_POOL_NBYTES = 128 * 2**20
+
+_epoch_pool = _EpochPool(EPOCH_POOL_SIZE, EPOCH_POOL_NBYTES)
+
+
+def _acquire_epoch(shape, dtype):
+    return _epoch_pool.acquire(shape, dtype)
+
+
+def release_epoch(epoch):
+    '''
+    Return an epoch captured by `capture_epoch` to the pool for reuse
+
+    The epoch must not be used after it is released since the array will be
+    overwritten when the next epoch of the same shape is captured. Releasing
+    epochs is optional.
+    '''
+    _epoch_pool.release(np.asarray(epoch))
+
+
+def _as_epoch(epoch_data, first_chunk):
+    # Restore the PipelineData attributes (e.g., s0, channel and metadata) of
+    # the first chunk captured to the assembled epoch.
+    if isinstance(first_chunk, PipelineData):
+        return PipelineData(epoch_data, fs=first_chunk.fs, s0=first_chunk.s0,
+                            channel=first_chunk.channel,
+                            metadata=first_chunk.metadata)
+    return epoch_data
+
+
 @coroutine
 def capture_epoch(epoch_s0, epoch_samples, info, target, fs=None,
                   auto_send=False):
     '''
     Coroutine to facilitate capture of a single epoch
 
-    This was written as a supporting function for `extract_epochs` (i.e., it
-    creates one `capture_epoch` for each epoch it is looking for), but can also
-    be used stand-alone to capture single epochs.
+    This can be used stand-alone to capture single epochs. To capture many
+    epochs from the same stream, `extract_epochs` (which uses `EpochTable`) is
+    more efficient.
 
     Parameters
     ----------
@@ -610,14 +699,23 @@ def capture_epoch(epoch_s0, epoch_samples, info, target, fs=None,
     target : callable
         Callable that receives a single argument. The argument will be an
         instance of PipelineData with three dimensions (epoch, channel, time).
+        Once the target is done with the epoch, it may hand it back via
+        `release_epoch` so that the array can be reused.
     auto_send : bool
         If true, automatically send samples as they are acquired.
     '''
     # This coroutine will continue until it acquires all the samples it needs.
     # It then provides the samples to the callback function and exits the while
-    # loop.
-    accumulated_data = []
+    # loop. Once we know the shape and dtype of the incoming data, we allocate
+    # `epoch_data` to hold the full epoch and copy each chunk into it as it
+    # arrives. `first_chunk` holds the first chunk copied so that we can
+    # reconstruct the PipelineData attributes (e.g., s0, channel) for the
+    # final epoch.
+    epoch_data = None
+    first_chunk = None
+    written = 0
     current_s0 = epoch_s0
+    epoch_samples = int(round(epoch_samples))
 
     # Info may be shared among multiple pipeline components. Make a copy so
     # that we don't accidentally affect other pipeline components.
@@ -640,7 +738,7 @@ def capture_epoch(epoch_s0, epoch_samples, info, target, fs=None,
             # `i` and determine how many samples `d` to extract from `data`.
             # It's possible that data does not contain the entire epoch. In
             # that case, we just pull out what we can and save it in
-            # `accumulated_data`. We then update start to point to the last
+            # `epoch_data`. We then update start to point to the last
             # acquired sample `i+d` and update duration to be the number of
             # samples we still need to capture.
             i = int(round(current_s0 - slb))
@@ -649,33 +747,269 @@ def capture_epoch(epoch_s0, epoch_samples, info, target, fs=None,
 
             # TODO: Not in love with this approach. I don't like the idea of
             # squashing md and info into existing metadata, but I don't want to
-            # add additional attributes to PipelineData.
-            if hasattr(c, 'metadata'):
+            # add additional attributes to PipelineData. Unless we are sending
+            # each chunk, the epoch takes its metadata from the first chunk so
+            # we only need to update that one.
+            if (auto_send or epoch_data is None) and hasattr(c, 'metadata'):
                 c.metadata.update(md)
                 c.metadata.update(info)
 
-            accumulated_data.append(c)
-            current_s0 += d
-            epoch_samples -= d
-
             if auto_send:
                 # TODO: Not tested
-                accumulated_data = concat(accumulated_data, axis=-1)
-                target(accumulated_data)
-                accumulated_data = []
+                current_s0 += d
+                epoch_samples -= d
+                target(concat([c], axis=-1))
                 if epoch_samples == 0:
                     break
+                continue
 
-            elif epoch_samples == 0:
-                data = concat(accumulated_data, axis=-1)
-                target(data)
+            if epoch_data is None:
+                # At this point, `epoch_samples` is the full epoch size since
+                # nothing has been captured yet.
+                epoch_data = _acquire_epoch(c.shape[:-1] + (epoch_samples,),
+                                            c.dtype)
+                first_chunk = c
+
+            epoch_data[..., written:written + d] = c
+            written += d
+            current_s0 += d
+            epoch_samples -= d
+
+            if epoch_samples == 0:
+                target(_as_epoch(epoch_data, first_chunk))
                 break
 
 
+class EpochTable:
+    '''
+    Tracks the epochs that are pending capture by `extract_epochs`
+
+    The state of each pending epoch (next sample needed, samples captured so
+    far and samples remaining) is stored in parallel arrays so that each
+    incoming chunk of data can be checked against all pending epochs in a
+    single vectorized pass rather than being sent to one `capture_epoch`
+    coroutine per epoch.
+
+    Parameters
+    ----------
+    fs : float
+        Sampling rate of input stream.
+    target : callable
+        Callable that receives a single argument, the captured epoch. If the
+        start of the epoch was missed, the epoch will be empty.
+    '''
+
+    # Value of `current` for rows that have been discarded. This ensures they
+    # never overlap with incoming data.
+    DISCARDED = np.iinfo(np.int64).max
+
+    def __init__(self, fs, target):
+        self.fs = fs
+        self.target = target
+
+        # Parallel arrays (one entry per row). We track the next sample needed
+        # rather than the first sample of the epoch so that `feed` can check
+        # for overlap without computing a temporary array. The arrays are
+        # allocated with spare capacity (only the first `n_rows` entries are
+        # in use) and grown by doubling so that adding an epoch is amortized
+        # O(1).
+        self.current = np.zeros(0, dtype=np.int64)
+        self.written = np.zeros(0, dtype=np.int64)
+        self.remaining = np.zeros(0, dtype=np.int64)
+        self.keys = []
+        self.info = []
+        self.metadata = []
+        self.buffers = []
+        self.first_chunks = []
+        self.n_rows = 0
+
+        # Rows for epochs that are complete or removed are marked as discarded
+        # and only compacted once they outnumber the pending epochs, so that
+        # removing an epoch is also amortized O(1).
+        self.n_discarded = 0
+
+        # Maps key to the row in the parallel arrays.
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key, epoch_s0, epoch_samples, info, prior_samples=()):
+        '''
+        Add epoch to list of pending epochs
+
+        Parameters
+        ----------
+        key : hashable
+            Unique identifier for the epoch.
+        epoch_s0 : int
+            Starting sample of epoch.
+        epoch_samples : int
+            Number of samples to capture.
+        info : dict
+            Dictionary of metadata that will be attached to the epoch.
+        prior_samples : iterable of (int, array)
+            Previously acquired chunks of data (and the sample each chunk
+            starts at) to retroactively capture the epoch from.
+        '''
+        # Info may be shared among multiple pipeline components. Make a copy so
+        # that we don't accidentally affect other pipeline components.
+        info = info.copy()
+        metadata = info.pop('metadata', {})
+
+        if self.n_rows == len(self.current):
+            self._grow()
+        i = self.n_rows
+        self.n_rows += 1
+        self.current[i] = epoch_s0
+        self.written[i] = 0
+        self.remaining[i] = epoch_samples
+        self.keys.append(key)
+        self.info.append(info)
+        self.metadata.append(metadata)
+        self.buffers.append(None)
+        self.first_chunks.append(None)
+
+        rows = np.array([i])
+        for slb, data in prior_samples:
+            if self._feed(slb, data, rows):
+                self._discard([i])
+                return
+        if key in self.index:
+            self._discard([i], release=True)
+            raise ValueError(f'Duplicate epochs not supported. Got {key}.')
+        self.index[key] = i
+
+    def remove(self, key):
+        '''
+        Remove epoch from list of pending epochs
+        '''
+        self._discard([self.index[key]], release=True)
+
+    def feed(self, slb, data):
+        '''
+        Capture samples from data for all pending epochs
+
+        Parameters
+        ----------
+        slb : int
+            Sample that data starts at.
+        data : array
+            Chunk of data.
+        '''
+        if not self.index:
+            return
+        done = self._feed(slb, data)
+        if done:
+            self._discard(done)
+
+    def _feed(self, slb, data, rows=None):
+        # Captures samples from data for the requested rows (or all rows if
+        # None). Returns the list of rows that are complete (or where the start
+        # was missed) and should be removed from the list of pending epochs.
+        # The offset into `data` and number of samples to copy are computed
+        # for all rows in a single vectorized pass, so the only per-epoch work
+        # done in Python is copying the data.
+        samples = data.shape[-1]
+        if rows is None:
+            current = self.current[:self.n_rows]
+            rows = np.flatnonzero(current <= (slb + samples))
+        else:
+            rows = rows[self.current[rows] <= (slb + samples)]
+        if len(rows) == 0:
+            return []
+
+        offsets = self.current[rows] - slb
+        counts = np.minimum(self.remaining[rows], samples - offsets)
+        written = self.written[rows]
+        remaining = self.remaining[rows]
+        self.current[rows] += counts
+        self.written[rows] += counts
+        self.remaining[rows] -= counts
+
+        done = []
+        for i, o, d, w, r in zip(rows.tolist(), offsets.tolist(),
+                                 counts.tolist(), written.tolist(),
+                                 remaining.tolist()):
+            if o < 0:
+                # We have missed the start of the epoch. Notify the callback
+                # of this.
+                epoch_s0 = slb + o - w
+                m = 'Missed samples for epoch of %d samples starting at %d'
+                log.warning(m, r, epoch_s0)
+                self.target(PipelineData([], fs=self.fs, s0=epoch_s0,
+                                         metadata=self.metadata[i]))
+                if self.buffers[i] is not None:
+                    release_epoch(self.buffers[i])
+                    self.buffers[i] = None
+                done.append(i)
+                continue
+
+            c = data[..., o:o + d]
+
+            if self.buffers[i] is None:
+                # The epoch takes its metadata from the first chunk, so we
+                # only need to update that one.
+                if hasattr(c, 'metadata'):
+                    c.metadata.update(self.metadata[i])
+                    c.metadata.update(self.info[i])
+                self.buffers[i] = _acquire_epoch(c.shape[:-1] + (r,), c.dtype)
+                self.first_chunks[i] = c
+            self.buffers[i][..., w:w + d] = c
+
+            if d == r:
+                self.target(_as_epoch(self.buffers[i], self.first_chunks[i]))
+                # The target now owns the buffer.
+                self.buffers[i] = None
+                done.append(i)
+
+        return done
+
+    def _grow(self):
+        n = max(16, len(self.current) * 2)
+        for name in ('current', 'written', 'remaining'):
+            old = getattr(self, name)
+            new = np.empty(n, dtype=old.dtype)
+            new[:self.n_rows] = old[:self.n_rows]
+            setattr(self, name, new)
+
+    def _discard(self, rows, release=False):
+        # If release is True, any partially captured epochs are returned to the
+        # pool since they will never be delivered to the target.
+        for i in rows:
+            if release and self.buffers[i] is not None:
+                release_epoch(self.buffers[i])
+            key = self.keys[i]
+            if self.index.get(key) == i:
+                del self.index[key]
+            self.current[i] = self.DISCARDED
+            self.keys[i] = self.info[i] = self.metadata[i] = None
+            self.buffers[i] = self.first_chunks[i] = None
+        self.n_discarded += len(rows)
+        if self.n_discarded > len(self.index):
+            self._compact()
+
+    def _compact(self):
+        keep = np.flatnonzero(self.current[:self.n_rows] != self.DISCARDED)
+        n = len(keep)
+        for name in ('current', 'written', 'remaining'):
+            values = getattr(self, name)
+            values[:n] = values[keep]
+        for name in ('keys', 'info', 'metadata', 'buffers', 'first_chunks'):
+            values = getattr(self, name)
+            setattr(self, name, [values[i] for i in keep.tolist()])
+        self.n_rows = n
+        self.n_discarded = 0
+        self.index = {k: i for i, k in enumerate(self.keys)}
+
+
 @coroutine
 def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
                    empty_queue_cb=None, removed_queue=None, prestim_time=0,
-                   poststim_time=0, source_complete=None):
+                   poststim_time=0, source_complete=None, min_batch=1):
     '''
     Coroutine to facilitate extracting epochs from an incoming stream of data
 
@@ -720,6 +1054,11 @@ def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
         the empty_queue_cb notification. If an Event, the empty_queue_cb
         notification will be fired once the Event is set and there are no more
         epochs to extract.
+    min_batch : int
+        Minimum number of epochs to accumulate before passing them to the
+        target. Useful when the target has a high fixed cost per call (e.g.,
+        plotting or writing to disk). Accumulated epochs are always passed to
+        the target once there are no more epochs pending capture.
     '''
     # The variable `tlb` tracks the number of samples that have been acquired
     # and reflects the lower bound of `data`. For example, if we have acquired
@@ -728,24 +1067,33 @@ def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
     # the first sample has an index of 0).
     tlb = 0
 
+    # Since we may capture very short, rapidly occurring epochs (at, say,
+    # 80 per second), I find it best to accumulate as many epochs as possible before
+    # calling the next target. This list will maintain the accumulated set.
+    epochs = []
+
     # This tracks the epochs that we are looking for. The key will be a
     # two-element tuple. key[0] is the starting time of the epoch to capture
     # and key[1] is a universally unique identifier. The key may be None, in
     # which case, you will not have the ability to capture two different epochs
     # that begin at the exact same time.
-    epoch_coroutines = {}
+    pending = EpochTable(fs, epochs.append)
 
     # Maintain a buffer of prior samples that can be used to retroactively
-    # capture the start of an epoch if needed.
-    prior_samples = []
+    # capture the start of an epoch if needed. Older samples are discarded
+    # from the left, so use a deque. `prior_ub` tracks the upper bound
+    # (i.e., one past the last sample) of each chunk in `prior_samples` so that
+    # we can check the age of a chunk without inspecting the array.
+    prior_samples = deque()
+    prior_ub = deque()
 
     # How much historical data to keep (for retroactively capturing epochs)
     buffer_samples = round(buffer_size * fs)
 
-    # Since we may capture very short, rapidly occurring epochs (at, say,
-    # 80 per second), I find it best to accumulate as many epochs as possible before
-    # calling the next target. This list will maintain the accumulated set.
-    epochs = []
+    # If the epoch size is fixed, the number of samples to capture is the same
+    # for every epoch.
+    if epoch_size:
+        fixed_epoch_samples = round((epoch_size + poststim_time + prestim_time) * fs)
 
     # Create dummy event and auto-set it to generate old behavior (where we
     # call the queue_complete_cb as soon as we have no more epochs to capture).
@@ -763,11 +1111,13 @@ def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
     while True:
         # Wait for new data to become available
         data = (yield)
+        n = data.shape[-1]
         prior_samples.append((tlb, data))
+        prior_ub.append(tlb + n)
 
-        # First, check to see what needs to be removed from epoch_coroutines.
+        # First, check to see what needs to be removed from pending.
         # If it doesn't exist, it may already have been captured.
-        skip = []
+        skip = set()
         n_remove = 0
         n_pop = 0
         while removed_queue:
@@ -775,25 +1125,19 @@ def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
 
             # This is a unique identifier.
             key = info['t0'], info.get('key', None)
-            if key not in epoch_coroutines:
+            if key not in pending:
                 n_remove += 1
-                skip.append(key)
+                skip.add(key)
             else:
-                epoch_coroutines.pop(key)
+                pending.remove(key)
                 n_pop += 1
 
         if n_remove or n_pop:
             log.debug('Marked %d epochs for removal, removed %d epochs', n_remove, n_pop)
 
-        # Send the data to each coroutine. If a StopIteration occurs,
-        # this means that the epoch has successfully been acquired and has
-        # been sent to the callback and we can remove it. Need to operate on
-        # a copy of list since it's bad form to modify a list in-place.
-        for key, epoch_coroutine in list(epoch_coroutines.items()):
-            try:
-                epoch_coroutine.send((tlb, data))
-            except StopIteration:
-                epoch_coroutines.pop(key)
+        # Capture the data for each pending epoch. Epochs that have been
+        # successfully acquired are sent to the callback and removed.
+        pending.feed(tlb, data)
 
         # Check to see if more epochs have been requested. Information will be
         # provided in seconds, but we need to convert this to number of
@@ -804,7 +1148,7 @@ def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
             info = queue.popleft()
             key = info['t0'], info.get('key', None)
             if key in skip:
-                skip.remove(key)
+                skip.discard(key)
                 n_invalid += 1
                 continue
             n_queued += 1
@@ -812,56 +1156,57 @@ def extract_epochs(fs, queue, epoch_size, target, buffer_size=0,
             # Figure out how many samples to capture for that epoch
             info['prestim_time'] = prestim_time
             info['poststim_time'] = poststim_time
-            info['epoch_size'] = epoch_size if epoch_size else info['duration']
-            total_epoch_size = info['epoch_size'] + poststim_time + prestim_time
-            epoch_samples = round(total_epoch_size * fs)
+            if epoch_size:
+                info['epoch_size'] = epoch_size
+                epoch_samples = fixed_epoch_samples
+            else:
+                info['epoch_size'] = info['duration']
+                total_epoch_size = info['duration'] + poststim_time + prestim_time
+                epoch_samples = round(total_epoch_size * fs)
             t0 = round((info['t0'] - prestim_time) * fs)
-            epoch_coroutine = capture_epoch(t0, epoch_samples, info,
-                                            epochs.append, fs)
-
-            try:
-                # Go through the data we've been caching to facilitate
-                # historical acquisition of data. If this completes without a
-                # StopIteration, then we have not finished capturing the full
-                # epoch.
-                for prior_sample in prior_samples:
-                    epoch_coroutine.send(prior_sample)
-                if key in epoch_coroutines:
-                    raise ValueError(f'Duplicate epochs not supported. Got {key}.')
-                epoch_coroutines[key] = epoch_coroutine
-            except StopIteration:
-                pass
+
+            # Go through the data we've been caching to facilitate historical
+            # acquisition of data. If the epoch is not complete, it will be
+            # captured as new data arrives. Chunks that end before the epoch
+            # starts are not needed, so skip ahead to the first chunk that may
+            # contain the start of the epoch.
+            i = bisect_left(prior_ub, t0)
+            pending.add(key, t0, epoch_samples, info,
+                        itertools.islice(prior_samples, i, None))
 
         if n_queued or n_invalid:
             log.debug('Queued %d epochs, %d were invalid', n_queued, n_invalid)
 
-        tlb = tlb + data.shape[-1]
+        tlb += n
 
         # Once the new segment of data has been processed, pass all complete
-        # epochs along to the next target.
-        if len(epochs) != 0:
+        # epochs along to the next target (as long as we have accumulated
+        # enough or there are no more epochs to wait for).
+        if epochs and (len(epochs) >= min_batch
+                       or (len(pending) == 0 and len(queue) == 0)):
             if isinstance(epochs[0], PipelineData):
                 merged = concat(epochs, axis=-3)
             else:
                 merged = np.concatenate([e[np.newaxis] for e in epochs], axis=0)
             target(merged)
-            epochs[:] = []
+
+            # The epochs have been copied into `merged`, so they can be reused.
+            for epoch in epochs:
+                release_epoch(epoch)
+            epochs.clear()
 
         # Check to see if any of the cached samples are older than the
         # specified buffer_samples and discard them.
-        while True:
-            oldest_samples = prior_samples[0]
-            tub = oldest_samples[0] + oldest_samples[1].shape[-1]
-            if tub < (tlb - buffer_samples):
-                prior_samples.pop(0)
-            else:
-                break
+        tub_min = tlb - buffer_samples
+        while prior_ub and prior_ub[0] < tub_min:
+            prior_samples.popleft()
+            prior_ub.popleft()
 
         if source_complete.is_set() \
                 and (len(queue) == 0) \
-                and (len(epoch_coroutines) == 0) \
+                and (len(pending) == 0) \
                 and (empty_queue_cb is not None):
-            # If queue and epoch coroutines are complete, call queue callback
+            # If queue and pending epochs are complete, call queue callback
             # once and only once.
             empty_queue_cb()
             empty_queue_cb = None
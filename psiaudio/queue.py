@@ -1,14 +1,19 @@
 import logging
 log = logging.getLogger(__name__)
 
-from collections import Counter
+from collections import Counter, OrderedDict
 import copy
 import itertools
+import random
 import uuid
 
 import numpy as np
 
 
+# Maximum number of released buffers to keep for each (shape, dtype).
+BUFFER_POOL_SIZE = 64
+
+
 class QueueEmptyError(Exception):
     pass
 
@@ -23,14 +28,43 @@ def as_iterator(x):
     return x
 
 
+def _broadcast(x, n, name):
+    '''
+    Return x if it is a sequence of length n, otherwise repeat x indefinitely
+    '''
+    # Check the common types first since isinstance is much cheaper than
+    # probing for `__len__`. Zero-dimensional arrays are scalars, and strings
+    # and dictionaries (e.g., metadata) are single values even though they are
+    # sized.
+    if isinstance(x, np.ndarray):
+        is_sequence = x.ndim > 0
+    elif isinstance(x, (list, tuple)):
+        is_sequence = True
+    else:
+        is_sequence = hasattr(x, '__len__') and \
+            not isinstance(x, (str, bytes, dict))
+    if not is_sequence:
+        return itertools.repeat(x)
+    if len(x) != n:
+        m = f'{name} must be a scalar or a sequence of length {n}'
+        raise ValueError(m)
+    return x
+
+
 class AbstractSignalQueue:
 
-    def __init__(self, fs=None):
+    def __init__(self, fs=None, with_pool=True):
         '''
         Parameters
         ----------
         fs : float
             Sampling rate of output that will be using this queue
+        with_pool : bool
+            If True, buffers returned by `pop_buffer` can be handed back to
+            the queue via `release_buffer` once the consumer is done with
+            them (e.g., after the samples have been written to the hardware).
+            Released buffers are reused by subsequent calls to `pop_buffer`
+            to minimize allocations in the audio generation loop.
         '''
         # Used internally to track intertrial silent period.
         self._delay_samples = 0
@@ -43,11 +77,17 @@ class AbstractSignalQueue:
 
         # Tracks order of items added to queue. Subclasses will incorporate
         # this into their algorithms to determine the actual ordering of the
-        # stimuli (e.g., first-in, first-out, interleaved, etc.).
-        self._ordering = []
-
-        # Current waveform generator for trials.
+        # stimuli (e.g., first-in, first-out, interleaved, etc.). This is an
+        # OrderedDict (the values are unused) so that membership tests and
+        # removal of keys are O(1). Use `_ordered_keys` when indexed access is
+        # needed.
+        self._ordering = OrderedDict()
+        self._ordering_keys = None
+
+        # Current waveform generator for trials. If the source is an array,
+        # `_source_pos` tracks the next sample to return.
         self._source = None
+        self._source_pos = 0
 
         # Total samples generated by queue
         self._samples = 0
@@ -77,6 +117,11 @@ class AbstractSignalQueue:
         # need to pause stimulus generation.
         self._generated = []
 
+        # Free list of output buffers, keyed by (samples, dtype), that have
+        # been released by the consumer and can be reused by `pop_buffer`.
+        self._with_pool = with_pool
+        self._buffer_pool = {}
+
     def clone(self):
         return copy.deepcopy(self)
 
@@ -154,21 +199,31 @@ class AbstractSignalQueue:
             if info['decrement']:
                 to_requeue.append(info['key'])
 
+        # Count the trials to requeue for each key. Counter preserves the order
+        # in which keys are first encountered, so we only need to visit each
+        # unique key once.
+        counts = Counter(to_requeue)
+
         # to_requeue is from last to first in time. Therefore, if we
         # encounter a key that isn't present in _ordering, we should insert
         # it at the beginning of the list.
-        for key in to_requeue:
+        for key in counts:
             if key not in self._ordering:
-                self._ordering.insert(0, key)
-
-        log.debug('Need to requeue:: %r', dict(Counter(to_requeue)))
-        trials = {k: self._data[k]['trials'] for k in self._data.keys()}
-        log.debug('Current trials:: %r', trials)
-        for key, count in Counter(to_requeue).items():
+                self._add_ordering(key, last=False)
+
+        # Building the summaries below is not free, so only do so if they will
+        # actually be logged.
+        debug = log.isEnabledFor(logging.DEBUG)
+        if debug:
+            log.debug('Need to requeue:: %r', dict(counts))
+            trials = {k: v['trials'] for k, v in self._data.items()}
+            log.debug('Current trials:: %r', trials)
+        for key, count in counts.items():
             log.debug('Adding %d trials for key %s back to queue', count, key)
             self._data[key]['trials'] += count
-        trials = {k: self._data[k]['trials'] for k in self._data.keys()}
-        log.debug('Current trials:: %r', trials)
+        if debug:
+            trials = {k: v['trials'] for k, v in self._data.items()}
+            log.debug('Current trials:: %r', trials)
 
     def resume(self, t=None):
         """
@@ -198,14 +253,19 @@ class AbstractSignalQueue:
 
     def _add_source(self, source, trials, delays, duration, metadata):
         key = uuid.uuid4()
-        if duration is None:
-            if isinstance(source, np.ndarray):
+        if isinstance(source, np.ndarray):
+            # ndarray.copy is much faster than the generic deepcopy protocol
+            # for large waveforms.
+            source = source.copy()
+            if duration is None:
                 duration = source.shape[-1]/self._fs
-            else:
+        else:
+            source = copy.deepcopy(source)
+            if duration is None:
                 duration = source.get_duration()
 
         data = {
-            'source': copy.deepcopy(source),
+            'source': source,
             'trials': trials,
             'requested_trials': trials,
             'delays': as_iterator(delays),
@@ -238,49 +298,43 @@ class AbstractSignalQueue:
 
     def insert(self, source, trials, delays=None, duration=None, metadata=None):
         k = self._add_source(source, trials, delays, duration, metadata)
-        self._ordering.insert(k)
+        self._add_ordering(k, last=False)
         return k
 
     def append(self, source, trials, delays=None, duration=None, metadata=None):
         k = self._add_source(source, trials, delays, duration, metadata)
-        self._ordering.append(k)
+        self._add_ordering(k)
         return k
 
     def extend(self, sources, trials, delays=None, duration=None,
                metadata=None):
-
-        base_err = '{param} must be a scalar or a sequence of length {n}'
         n = len(sources)
-
-        if np.iterable(trials):
-            if len(trials) != n:
-                raise ValueError(base_err.format('trials', n))
-        else:
-            trials = itertools.cycle([trials])
-
-        if np.iterable(delays):
-            if len(delays) != n:
-                raise ValueError(base_err.format('delays', n))
-        else:
-            delays = itertools.cycle([delays])
-
-        if np.iterable(duration):
-            if len(duration) != n:
-                raise ValueError(base_err.format('duration', n))
-        else:
-            duration = itertools.cycle([duration])
-
-        if np.iterable(metadata):
-            if len(metadata) != n:
-                raise ValueError(base_err.format('metadata', n))
-        else:
-            metadata = itertools.cycle([metadata])
+        trials = _broadcast(trials, n, 'trials')
+        delays = _broadcast(delays, n, 'delays')
+        duration = _broadcast(duration, n, 'duration')
+        metadata = _broadcast(metadata, n, 'metadata')
 
         uuids = []
         for args in zip(sources, trials, delays, duration, metadata):
             uuids.append(self.append(*args))
         return uuids
 
+    def _add_ordering(self, key, last=True):
+        self._ordering[key] = None
+        if not last:
+            self._ordering.move_to_end(key, last=False)
+        self._ordering_keys = None
+
+    def _ordered_keys(self):
+        '''
+        Return list of keys in queue order
+
+        The list is cached until the ordering changes. Do not modify it.
+        '''
+        if self._ordering_keys is None:
+            self._ordering_keys = list(self._ordering)
+        return self._ordering_keys
+
     def count_factories(self):
         return len(self._ordering)
 
@@ -316,7 +370,8 @@ class AbstractSignalQueue:
         '''
         Removes key from queue entirely, regardless of number of trials
         '''
-        self._ordering.remove(key)
+        del self._ordering[key]
+        self._ordering_keys = None
 
     def decrement_key(self, key, n=1):
         """
@@ -343,21 +398,22 @@ class AbstractSignalQueue:
         self._notify('decrement', {'key': key})
         return False
 
-    def _get_samples_waveform(self, samples):
-        if samples > len(self._source):
-            waveform = self._source
+    def _get_samples_waveform(self, out):
+        lb = self._source_pos
+        ub = min(lb + len(out), len(self._source))
+        out[:ub - lb] = self._source[lb:ub]
+        self._source_pos = ub
+        if ub == len(self._source):
             self._source = None
-        else:
-            waveform = self._source[:samples]
-            self._source = self._source[samples:]
-        return waveform
+        return ub - lb
 
-    def _get_samples_generator(self, samples):
-        samples = min(self._source.n_samples_remaining(), samples)
-        waveform = self._source.next(samples)
+    def _get_samples_generator(self, out):
+        samples = min(self._source.n_samples_remaining(), len(out))
+        samples = int(samples)
+        out[:samples] = self._source.next(samples)
         if self._source.is_complete():
             self._source = None
-        return waveform
+        return samples
 
     def next_trial(self, decrement=True):
         '''
@@ -374,7 +430,7 @@ class AbstractSignalQueue:
             self._source.reset()
             self._get_samples = self._get_samples_generator
         except AttributeError:
-            self._source = data['source']
+            self._source_pos = 0
             self._get_samples = self._get_samples_waveform
 
         # Now, determine the next ITI (as specified by the delay generator)
@@ -394,6 +450,41 @@ class AbstractSignalQueue:
         self._generated.append(info)
         self._notify('added', info)
 
+    def acquire_buffer(self, samples, dtype=np.float64):
+        '''
+        Return an uninitialized buffer of the requested size
+
+        If a buffer of matching size and dtype has been released back to the
+        queue, it will be reused. Otherwise, a new buffer is allocated.
+        '''
+        dtype = np.dtype(dtype)
+        pool = self._buffer_pool.get(((samples,), dtype))
+        if pool:
+            return pool.pop()
+        return np.empty(samples, dtype=dtype)
+
+    def release_buffer(self, buffer):
+        '''
+        Return a buffer obtained from `pop_buffer` to the queue for reuse
+
+        The caller must not read from or write to the buffer after releasing
+        it since the contents will be overwritten by a subsequent call to
+        `pop_buffer`. This is a no-op if the queue was created with
+        `with_pool=False`.
+        '''
+        if not self._with_pool:
+            return
+        if buffer.ndim != 1:
+            raise ValueError('Only buffers obtained from pop_buffer can be '
+                             'released')
+        pool = self._buffer_pool.setdefault((buffer.shape, buffer.dtype), [])
+        # Handing the same buffer out twice would allow two consumers to
+        # overwrite each other's samples.
+        if any(b is buffer for b in pool):
+            raise ValueError('Buffer has already been released')
+        if len(pool) < BUFFER_POOL_SIZE:
+            pool.append(buffer)
+
     def pop_buffer(self, samples, decrement=True):
         '''
         Return the requested number of samples
@@ -402,47 +493,56 @@ class AbstractSignalQueue:
         returns requested number of samples.  If a partial fragment of a
         waveform is returned, the remaining part will be returned on subsequent
         calls to this function.
+
+        If the queue was created with `with_pool=True`, the caller may return
+        the buffer to the queue via `release_buffer` once it is done with it.
         '''
-        waveforms = []
-        while samples > 0:
+        # The output size is known up front, so we allocate once and have
+        # `_pop_buffer` write each fragment directly into the output.
+        out = self.acquire_buffer(samples)
+        offset = 0
+        while offset < samples:
             try:
-                waveform = self._pop_buffer(samples, decrement)
+                n = self._pop_buffer(out, offset, samples - offset, decrement)
             except QueueEmptyError:
                 log.info('Queue is empty')
-                waveform = np.zeros(samples)
+                n = samples - offset
+                out[offset:] = 0
                 self._empty = True
                 self._notify('empty', {})
-            samples -= len(waveform)
-            self._samples += len(waveform)
-            waveforms.append(waveform)
-        waveform = np.concatenate(waveforms, axis=-1)
-        log.trace('Generated %d samples', len(waveform))
-        return waveform
-
-    def _pop_buffer(self, samples, decrement):
+            offset += n
+            self._samples += n
+        log.trace('Generated %d samples', samples)
+        return out
+
+    def _pop_buffer(self, out, offset, samples, decrement):
         '''
         Encodes logic for deciding what segment needs to be generated. It must
-        return *up to* the number of samples requested, but can be less if
-        needed.
+        write *up to* the number of samples requested into `out` starting at
+        `offset` and return the number of samples written (which can be less
+        than requested if needed).
         '''
-        # If paused, return a stream of zeros.
+        # If paused, fill with zeros. Silence is written directly into the
+        # output so we never allocate a zero-filled array.
         if self._paused:
-            return np.zeros(samples)
+            out[offset:offset+samples] = 0
+            return samples
 
         # Load samples from current source
         if self._source is not None:
-            return self._get_samples(samples)
+            return self._get_samples(out[offset:offset+samples])
 
-        # Insert intertrial interval delay if one exists
+        # Insert intertrial interval delay (zeros) if one exists
         if self._delay_samples > 0:
             n = min(self._delay_samples, samples)
             self._delay_samples -= n
-            return np.zeros(n)
+            out[offset:offset+n] = 0
+            return n
 
         # Set up next trial
         if self._source is None:
             self.next_trial(decrement)
-            return np.empty(0)
+            return 0
 
     def get_closest_key(self, t):
         for info in self._generated[::-1]:
@@ -462,7 +562,7 @@ class FIFOSignalQueue(AbstractSignalQueue):
     def next_key(self):
         if len(self._ordering) == 0:
             raise QueueEmptyError
-        return self._ordering[0]
+        return next(iter(self._ordering))
 
 
 class InterleavedFIFOSignalQueue(AbstractSignalQueue):
@@ -490,7 +590,7 @@ class InterleavedFIFOSignalQueue(AbstractSignalQueue):
             raise QueueEmptyError
         while True:
             self._i = (self._i + 1) % len(self._ordering)
-            key = self._ordering[self._i]
+            key = self._ordered_keys()[self._i]
             if self._keep_complete_waveforms:
                 break
             elif self._data[key]['trials'] > 0:
@@ -516,13 +616,25 @@ class InterleavedFIFOSignalQueue(AbstractSignalQueue):
 class RandomSignalQueue(AbstractSignalQueue):
     '''
     Return waveforms in random order
+
+    Parameters
+    ----------
+    seed : {None, int}
+        Seed for the random number generator. If None, the sequence will not
+        be reproducible.
     '''
 
+    def __init__(self, fs=None, seed=None, **kwargs):
+        super().__init__(fs=fs, **kwargs)
+        # Drawing a single integer is considerably faster using the standard
+        # library generator than NumPy's.
+        self._rng = random.Random(seed)
+
     def next_key(self):
         if len(self._ordering) == 0:
             raise QueueEmptyError
-        i = np.random.randint(0, len(self._ordering))
-        return self._ordering[i]
+        i = self._rng.randrange(len(self._ordering))
+        return self._ordered_keys()[i]
 
 
 class BlockedRandomSignalQueue(InterleavedFIFOSignalQueue):
@@ -541,7 +653,7 @@ class BlockedRandomSignalQueue(InterleavedFIFOSignalQueue):
             self._rng.shuffle(i)
             self._i = i.tolist()
         i = self._i.pop()
-        return self._ordering[i]
+        return self._ordered_keys()[i]
 
 
 class GroupedFIFOSignalQueue(FIFOSignalQueue):
@@ -565,7 +677,7 @@ class GroupedFIFOSignalQueue(FIFOSignalQueue):
         if len(self._ordering) == 0:
             raise QueueEmptyError
         self._i = (self._i + 1) % self._group_size
-        return self._ordering[self._i]
+        return self._ordered_keys()[self._i]
 
     def decrement_key(self, key, n=1):
         if key not in self._ordering:
@@ -574,12 +686,12 @@ class GroupedFIFOSignalQueue(FIFOSignalQueue):
 
         # Check to see if the group is complete. Return from method if not
         # complete.
-        for key in self._ordering[:self._group_size]:
+        for key in self._ordered_keys()[:self._group_size]:
             if self._data[key]['trials'] > 0:
                 return False
 
         # If complete, remove the keys
-        for key in self._ordering[:self._group_size]:
+        for key in self._ordered_keys()[:self._group_size]:
             self.remove_key(key)
 
         return True
@@ -1,7 +1,7 @@
 import logging
 log = logging.getLogger(__name__)
 
-from functools import partial, wraps
+from functools import lru_cache, partial, wraps
 import itertools
 from pathlib import Path
 
@@ -20,10 +20,13 @@ def fast_cache(f):
     kwd_marker = object()
     @wraps(f)
     def wrapper(*args, **kw):
-        key = args + (kwd_marker,) + tuple(sorted(kw.items()))
-        if key not in cache:
-            cache[key] = f(*args, **kw)
-        return cache[key]
+        key = args + (kwd_marker,) + tuple(sorted(kw.items())) if kw else args
+        # Cache hits are the common case, so only do a single lookup for them.
+        try:
+            return cache[key]
+        except KeyError:
+            result = cache[key] = f(*args, **kw)
+            return result
     return wrapper
 
 
@@ -66,6 +69,43 @@ class Waveform:
             raise ValueError('Waveform does not have a finite duration')
         return self.next(samples)
 
+    def fill(self, out, chunksize=None):
+        '''
+        Write the next `out.shape[-1]` samples of the waveform into `out`
+
+        Parameters
+        ----------
+        out : array
+            Array to write the waveform to.
+        chunksize : {None, int}
+            If provided, the waveform is generated in chunks of (at most) this
+            many samples. Otherwise, it is generated in a single call.
+
+        Returns
+        -------
+        out : array
+            The array that was filled.
+        '''
+        samples = out.shape[-1]
+        if samples == 0:
+            return out
+        if chunksize is None:
+            chunksize = samples
+        elif chunksize <= 0:
+            raise ValueError('chunksize must be a positive integer')
+        for i in range(0, samples, chunksize):
+            self._fill_chunk(out[..., i:i+chunksize])
+        return out
+
+    def _fill_chunk(self, out):
+        '''
+        Write the next `out.shape[-1]` samples of the waveform into `out`
+
+        Subclasses that can generate the waveform directly into a buffer should
+        override this.
+        '''
+        out[...] = self.next(out.shape[-1])
+
     def get_duration(self):
         raise NotImplementedException
 
@@ -204,6 +244,10 @@ class GateFactory(Modulator):
 
     def next(self, samples):
         token = self.input_factory.next(samples)
+        # Some factories (e.g., SilenceFactory) return read-only views of a
+        # shared buffer. Copy these since the gate is applied in place.
+        if not token.flags.writeable:
+            token = token.copy()
         lb = self.start_samples - self.offset
         ub = lb + self.duration_samples
         if lb >= 0:
@@ -248,12 +292,24 @@ def envelope(window, fs, duration, rise_time=None, offset=0, start_time=0,
         Callable that can transform the resulting envelope into the desired
         units.
     '''
-    i_env_lb = int(round(start_time * fs))
-    i_duration = int(round(duration * fs))
-    i_env_ub = i_env_lb + i_duration
-
+    env_params = _envelope_params(window, fs, duration, rise_time, start_time)
     if samples == 'auto':
+        _, i_env_lb, i_duration, _ = env_params
         samples = i_env_lb + i_duration
+    env = _envelope(*env_params, offset, samples)
+    if transform is not None:
+        env = transform(env)
+    return env
+
+
+def _envelope_params(window, fs, duration, rise_time=None, start_time=0):
+    '''
+    Convert envelope parameters to samples and load the ramp
+
+    Returns the tuple of parameters needed by `_envelope`.
+    '''
+    i_env_lb = int(round(start_time * fs))
+    i_duration = int(round(duration * fs))
 
     if rise_time is None:
         i_rise_time = int(np.floor(i_duration / 2))
@@ -265,10 +321,34 @@ def envelope(window, fs, duration, rise_time=None, offset=0, start_time=0,
         m = f'Rise time ({rise_time}s) longer than envelope duration ({duration}s)'
         raise ValueError(m)
 
-    if window == 'cosine-squared':
-        ramp = cos2ramp(2 * i_rise_time)
+    ramp = _ramp(window, 2 * i_rise_time)
+    return ramp, i_env_lb, i_duration, i_rise_time
+
+
+def _envelope(ramp, i_env_lb, i_duration, i_rise_time, offset, samples,
+              out=None):
+    '''
+    Generate fragment of envelope. All parameters are in samples.
+
+    If provided, the envelope is written to `out` (which must be at least
+    `samples` long). Otherwise, a new array is allocated.
+    '''
+    if out is None:
+        out = np.empty(samples)
     else:
-        ramp = getattr(signal.windows, window)(2 * i_rise_time)
+        out = out[:samples]
+    i_env_ub = i_env_lb + i_duration
+
+    # When generating in small chunks, most fragments fall entirely within the
+    # steady-state portion of the envelope or entirely outside of it. Handle
+    # these cases directly.
+    if (i_env_lb + i_rise_time) <= offset and \
+            (offset + samples) <= (i_env_ub - i_rise_time):
+        out[:] = 1
+        return out
+    if offset >= i_env_ub or (offset + samples) <= i_env_lb:
+        out[:] = 0
+        return out
 
     # Maximum number of steady state samples possible to return. If it exceeds
     # samples, clip it.
@@ -277,8 +357,10 @@ def envelope(window, fs, duration, rise_time=None, offset=0, start_time=0,
     def get_i(offset, i_start):
         return max(offset - i_start, 0)
 
+    # Use the builtin min/max rather than np.clip. This is called with scalars
+    # several times per chunk and np.clip has a lot of overhead for scalars.
     def get_n(i_max, offset, i_start, max_n):
-        return np.clip(i_max - (offset - i_start), 0, min(i_max, max_n))
+        return min(max(i_max - (offset - i_start), 0), i_max, max_n)
 
     n_null_pre = get_n(i_env_lb, offset, 0, samples)
     samples -= n_null_pre
@@ -294,22 +376,52 @@ def envelope(window, fs, duration, rise_time=None, offset=0, start_time=0,
     n_offset = get_n(i_rise_time, offset, i_env_ub - i_rise_time, samples)
     samples -= n_offset
 
-    n_null_post = samples
-
-    env = np.concatenate((
-        np.zeros(n_null_pre),
-        ramp[i_onset:i_onset+n_onset],
-        np.ones(n_ss),
-        ramp[i_rise_time+i_offset:i_rise_time+i_offset+n_offset],
-        np.zeros(n_null_post),
-    ), axis=-1)
-    if transform is not None:
-        env = transform(env)
-    return env
+    # Fill each segment of the envelope in place.
+    i = n_null_pre
+    out[:i] = 0
+    out[i:i+n_onset] = ramp[i_onset:i_onset+n_onset]
+    i += n_onset
+    out[i:i+n_ss] = 1
+    i += n_ss
+    out[i:i+n_offset] = ramp[i_rise_time+i_offset:i_rise_time+i_offset+n_offset]
+    i += n_offset
+    out[i:] = 0
+    return out
 
 
 def cos2ramp(m):
-    return np.sin(np.pi * np.arange(m) / m)**2
+    # Evaluates sin(pi * k / m)**2 for k in 0 ... m-1 using the identity
+    # sin(x)**2 = (1 - cos(2x)) / 2 so that all operations can be done in place.
+    # The ramp is symmetric (i.e., ramp[k] == ramp[m-k]), so we only need to
+    # evaluate the first half.
+    ramp = np.empty(m)
+    if m == 0:
+        return ramp
+    h = min(m // 2 + 1, m)
+    first_half = ramp[:h]
+    np.multiply(np.arange(h), 2 * np.pi / m, out=first_half)
+    np.cos(first_half, out=first_half)
+    first_half *= -0.5
+    first_half += 0.5
+    ramp[h:] = ramp[1:m-h+1][::-1]
+    return ramp
+
+
+@lru_cache(maxsize=64)
+def _ramp(window, m):
+    '''
+    Return window of m samples used for the rise and fall of an envelope
+
+    The same ramps are requested repeatedly (e.g., for each chunk generated by
+    an EnvelopeFactory), so they are cached. The array is read-only since it
+    is shared by all callers. lru_cache is thread-safe.
+    '''
+    if window == 'cosine-squared':
+        ramp = cos2ramp(m)
+    else:
+        ramp = getattr(signal.windows, window)(m)
+    ramp.flags.writeable = False
+    return ramp
 
 
 @fast_cache
@@ -319,32 +431,84 @@ def cos2envelope(fs, duration, rise_time, offset=0, start_time=0,
                     start_time, samples)
 
 
+# Maximum number of envelope fragments cached by each EnvelopeFactory.
+ENVELOPE_CACHE_SIZE = 64
+
+
 class EnvelopeFactory(GateFactory):
 
     def __init__(self, envelope, fs, duration, rise_time, input_factory,
-                 start_time=0, transform=None):
+                 start_time=0, transform=None, dtype=np.double):
         self.rise_time = rise_time
         self.envelope = envelope
         self.transform = transform
+        self.dtype = dtype
         super().__init__(fs, start_time, duration, input_factory)
+        # Convert the envelope parameters to samples once rather than on every
+        # call to `next`.
+        self.env_params = _envelope_params(envelope, fs, duration, rise_time,
+                                           start_time)
+        # Each trial restarts the envelope at offset 0, so the same fragments
+        # are typically requested on every trial. Cache them, keyed by
+        # (offset, samples).
+        self.env_cache = {}
+
+    def get_envelope(self, offset, samples, out=None):
+        '''
+        Return the requested fragment of the envelope
+
+        Unlike `next`, this does not depend on (or update) the state of the
+        factory, so it is safe to call from multiple threads (e.g., to fill
+        sections of a long envelope in parallel) as long as each call is given
+        its own `out`.
+
+        Parameters
+        ----------
+        offset : int
+            Sample (relative to the start of the envelope) to begin at.
+        samples : int
+            Number of samples to generate.
+        out : {None, array}
+            If provided, the envelope is written to this array.
+        '''
+        env = _envelope(*self.env_params, offset, samples, out=out)
+        if self.transform is not None:
+            env = self.transform(env)
+        return env
+
+    def _next_envelope(self, samples):
+        key = self.offset, samples
+        try:
+            env = self.env_cache[key]
+        except KeyError:
+            if len(self.env_cache) >= ENVELOPE_CACHE_SIZE:
+                self.env_cache.clear()
+            env = np.empty(samples, dtype=self.dtype)
+            env = self.get_envelope(self.offset, samples, env)
+            # The fragment is shared by all subsequent requests.
+            env.flags.writeable = False
+            self.env_cache[key] = env
+        self.offset += samples
+        return env
 
     def next(self, samples):
         token = self.input_factory.next(samples)
-        env = envelope(window=self.envelope, fs=self.fs,
-                       duration=self.duration, rise_time=self.rise_time,
-                       offset=self.offset, start_time=self.start_time,
-                       samples=samples, transform=self.transform)
-        waveform = env*token
-        self.offset += samples
-        return waveform
+        return np.multiply(self._next_envelope(samples), token,
+                           dtype=self.dtype)
+
+    def _fill_chunk(self, out):
+        # Write the product of the envelope and the input directly to `out`.
+        samples = out.shape[-1]
+        token = self.input_factory.next(samples)
+        np.multiply(self._next_envelope(samples), token, out=out)
 
 
 class Cos2EnvelopeFactory(EnvelopeFactory):
 
     def __init__(self, fs, duration, rise_time, input_factory,
-                 start_time=0):
+                 start_time=0, dtype=np.double):
         super().__init__('cosine-squared', fs, duration, rise_time,
-                         input_factory, start_time)
+                         input_factory, start_time, dtype=dtype)
 
     def max_amplitude(self):
         return self.input_factory.max_amplitude()
@@ -374,15 +538,27 @@ def _sam_envelope(offset, samples, fs, depth, fm, delay, eq_phase, eq_power):
     sam_n = samples-delay_n
 
     sam_offset = offset-delay_n
-    t = (np.arange(sam_n, dtype=np.double) + sam_offset)/fs
-    sam_envelope = depth/2.0*np.cos(2.0*np.pi*fm*t+eq_phase)+1.0-depth/2.0
+
+    # Fill the delay and modulated portions of a single preallocated array
+    # rather than building each portion and concatenating them.
+    env = np.empty(samples)
+    env[:delay_n] = 1
+    sam_envelope = env[delay_n:]
+
+    t = np.arange(sam_n, dtype=np.double)
+    t += sam_offset
+    t /= fs
+    t *= 2.0*np.pi*fm
+    t += eq_phase
+    np.cos(t, out=sam_envelope)
+    sam_envelope *= depth/2.0
+    sam_envelope += 1.0
+    sam_envelope -= depth/2.0
 
     # Ensure that we scale the waveform so that the total power remains equal
     # to that of an unmodulated token.
     sam_envelope *= 1.0/eq_power
-
-    delay_envelope = np.ones(delay_n)
-    return np.concatenate((delay_envelope, sam_envelope))
+    return env
 
 
 @fast_cache
@@ -1001,26 +1177,50 @@ def tone(fs, frequency, level, phase=0, polarity=1, calibration=None,
 
     # Since the scaling factor is based on Vrms, we need to convert this to the
     # peak-to-peak scaling factor.
-    t = (np.arange(samples, dtype=np.double) + offset)/fs
-    return polarity * rms * np.sqrt(2) * np.cos(2 * np.pi * t * frequency + phase)
+    return _tone(fs, frequency, polarity * rms * np.sqrt(2), phase, samples,
+                 offset)
+
+
+def _tone(fs, frequency, sf, phase, samples, offset):
+    t = np.arange(samples, dtype=np.double)
+    t += offset
+    t /= fs
+    if np.ndim(frequency) or np.ndim(phase) or np.ndim(sf):
+        # The parameters may broadcast to a different shape than t.
+        return sf * np.cos(2 * np.pi * t * frequency + phase)
+    # Evaluate in place to avoid allocating a temporary for each step. The
+    # order of operations is the same as the expression above so the result is
+    # identical.
+    t *= 2 * np.pi
+    t *= frequency
+    t += phase
+    np.cos(t, out=t)
+    t *= sf
+    return t
 
 
 class ToneFactory(Carrier):
 
     def __init__(self, fs, frequency, level, phase=0, polarity=1,
-                 calibration=None):
+                 calibration=None, dtype=np.double):
         vars(self).update(locals())
         self.reset()
 
     def reset(self):
         self.offset = 0
+        # Looking up the calibration can be expensive, so compute the peak
+        # scaling factor once per trial rather than on each call to `next`.
+        rms = self.level if self.calibration is None \
+            else self.calibration.get_sf(self.frequency, self.level)
+        self.sf = self.polarity * rms * np.sqrt(2)
 
     def next(self, samples):
         # Note. At least for 5 msec tones it's faster to just compute the array
         # rather than cache the result.
-        waveform = tone(self.fs, self.frequency, self.level, self.phase,
-                        self.polarity, calibration=self.calibration,
-                        offset=self.offset, samples=samples)
+        # The phase is always computed in double precision since the time
+        # vector loses precision quickly in single precision.
+        waveform = _tone(self.fs, self.frequency, self.sf, self.phase, samples,
+                         self.offset).astype(self.dtype, copy=False)
         self.offset += samples
         return waveform
 
@@ -1144,14 +1344,27 @@ class SilenceFactory(Carrier):
     Notes
     -----
     The fill_value can be set to a number other than zero for testing (e.g., to
-    characterize the effect of a transformation).
+    characterize the effect of a transformation). If dtype is None, it is
+    inferred from fill_value.
+
+    Since every sample is identical, `next` returns a read-only view of a
+    shared buffer rather than allocating a new array each time. Use `copy` on
+    the result if you need to modify it.
     '''
 
-    def __init__(self, fill_value=0):
+    def __init__(self, fill_value=0, dtype=None):
         self.fill_value = fill_value
+        self.dtype = dtype
+        self.buffer = np.full(0, fill_value, dtype=dtype)
 
     def next(self, samples):
-        return np.full(samples, self.fill_value)
+        if len(self.buffer) < samples:
+            # Grow geometrically so that requests for slowly increasing
+            # numbers of samples don't trigger a reallocation each time.
+            n = max(samples, 2 * len(self.buffer))
+            self.buffer = np.full(n, self.fill_value, dtype=self.dtype)
+            self.buffer.flags.writeable = False
+        return self.buffer[:samples]
 
     def reset(self):
         pass
@@ -1534,6 +1747,11 @@ def ramped_tone(fs, frequency, level, duration, rise_time=None,
                 window='cosine-squared', phase=0, calibration=None):
     carrier = tone(fs=fs, frequency=frequency, level=level, phase=phase,
                    calibration=calibration, duration=duration)
-    env = envelope(window=window, fs=fs, rise_time=rise_time,
-                   duration=duration)
-    return carrier * env
+    # The envelope is one everywhere except for the onset and offset ramps, so
+    # rather than generating the full envelope and multiplying the entire
+    # carrier by it, only scale the ramp portions of the carrier (in place).
+    ramp, _, i_duration, i_rise_time = \
+        _envelope_params(window, fs, duration, rise_time)
+    carrier[..., :i_rise_time] *= ramp[:i_rise_time]
+    carrier[..., i_duration-i_rise_time:i_duration] *= ramp[i_rise_time:]
+    return carrier
@@ -77,3 +77,10 @@ def assert_chunked_generation(factory_class, kwargs, chunksize, n_chunks,
         assert_array_equal(unchunked_samples, chunked_samples)
     else:
         assert_array_almost_equal(unchunked_samples, chunked_samples)
+
+    # Writing the chunks directly to a preallocated buffer should give exactly
+    # the same result as concatenating the chunks.
+    factory.reset()
+    filled_samples = np.empty_like(unchunked_samples)
+    factory.fill(filled_samples, chunksize)
+    assert_array_equal(filled_samples, chunked_samples)
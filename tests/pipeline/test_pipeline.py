@@ -79,6 +79,60 @@ def test_capture_epoch(fs, data, request):
     assert result[0].channel == expected.channel
 
 
+def test_capture_epoch_release(data2d):
+    result = []
+
+    def capture(s0, samples):
+        cr = pipeline.capture_epoch(s0, samples, {}, result.append)
+        with pytest.raises(StopIteration):
+            cr.send((0, data2d))
+        return result[-1]
+
+    e1 = capture(100, 500)
+    e2 = capture(1000, 500)
+    assert not np.shares_memory(e1, e2)
+
+    # Once released, the array is reused for the next epoch of the same shape.
+    pipeline.release_epoch(e1)
+    e3 = capture(5000, 500)
+    assert np.shares_memory(e1, e3)
+    np.testing.assert_array_equal(e3, data2d[..., 5000:5500])
+
+
+def test_epoch_pool_bounded():
+    nbytes = 100 * 8
+    pool = pipeline._EpochPool(max_arrays=2, max_nbytes=nbytes * 3)
+
+    # Per-shape limit
+    for i in range(3):
+        pool.release(np.zeros(100))
+    assert pool.nbytes == nbytes * 2
+
+    # Releasing other shapes evicts the least recently used shape first.
+    a = np.zeros(101)
+    b = np.zeros(99)
+    pool.release(a)
+    pool.release(b)
+    assert pool.nbytes <= nbytes * 3
+    assert pool.acquire((101,), np.double) is a
+    assert pool.acquire((99,), np.double) is b
+    assert pool.nbytes == nbytes
+    assert pool.acquire((100,), np.double) is not None
+    assert pool.nbytes == 0
+
+    # Arrays larger than the pool are never kept.
+    pool.release(np.zeros(1000))
+    assert pool.nbytes == 0
+
+
+def test_capture_epoch_float_samples(data2d):
+    result = []
+    cr = pipeline.capture_epoch(10, 100.0, {}, result.append)
+    with pytest.raises(StopIteration):
+        cr.send((0, data2d))
+    np.testing.assert_array_equal(result[0], data2d[..., 10:110])
+
+
 @pytest.mark.parametrize('data_fixture,', ['data1d', 'data2d'])
 def test_extract_epochs(fs, data_fixture, request):
     if data_fixture == 'data1d':
@@ -98,6 +152,102 @@ def test_extract_epochs(fs, data_fixture, request):
     assert_pipeline_data_equal(actual, expected)
 
 
+def test_extract_epochs_min_batch(data1d):
+    queue, expected, epoch_size = queue_epochs(data1d)
+    batches = []
+    cr = pipeline.extract_epochs(fs=data1d.fs, queue=queue,
+                                 epoch_size=epoch_size, target=batches.append,
+                                 min_batch=2)
+    for o in range(0, data1d.shape[-1], 100):
+        cr.send(data1d[..., o:o+100])
+
+    # The first two epochs are delivered together once both are captured. The
+    # last one is delivered on its own once there are no more pending epochs.
+    assert [b.n_epochs for b in batches] == [2, 1]
+    actual = pipeline.concat(batches, axis=-3)
+    assert_pipeline_data_equal(actual, expected)
+
+
+def check_epoch_table(data):
+    result = []
+    table = pipeline.EpochTable(data.fs, result.append)
+    table.add('A', 100, 50, {'metadata': {'epoch': 'A'}})
+    table.add('B', 120, 500, {})
+    table.add('C', 130, 10, {})
+    assert len(table) == 3
+
+    with pytest.raises(ValueError):
+        table.add('A', 100, 50, {})
+
+    table.remove('C')
+    assert 'C' not in table
+
+    table.feed(0, data[..., :200])
+    assert len(result) == 1
+    np.testing.assert_array_equal(result[0], data[..., 100:150])
+    assert result[0].s0 == 100
+    assert result[0].metadata['epoch'] == 'A'
+    assert 'A' not in table
+    assert 'B' in table
+
+    table.feed(200, data[..., 200:1000])
+    assert len(result) == 2
+    np.testing.assert_array_equal(result[1], data[..., 120:620])
+    assert len(table) == 0
+
+    # Start of epoch has already passed and the data is no longer available.
+    table.add('D', 10, 10, {}, [(1000, data[..., 1000:1100])])
+    assert len(result) == 3
+    assert result[2].shape[-1] == 0
+    assert len(table) == 0
+
+
+def test_epoch_table(data1d, data2d):
+    for data in (data1d, data2d):
+        check_epoch_table(data)
+
+
+def test_epoch_table_remove_many(data1d):
+    result = []
+    table = pipeline.EpochTable(data1d.fs, result.append)
+    for i in range(5000):
+        table.add(i, 100 + i * 10, 20, {})
+    for i in range(0, 5000, 5):
+        table.add(('late', i), 200 + i * 10, 20, {})
+    # Removing most of the epochs at once should leave the remaining ones
+    # intact (and be fast).
+    for i in range(5000):
+        if i % 10:
+            table.remove(i)
+    assert len(table) == 1500
+    for i in range(0, 60000, 1000):
+        table.feed(i, data1d[..., i:i+1000])
+    assert len(table) == 0
+    expected = sorted([100 + i * 10 for i in range(0, 5000, 10)] +
+                      [200 + i * 10 for i in range(0, 5000, 5)])
+    assert sorted(r.s0 for r in result) == expected
+    for r in result:
+        np.testing.assert_array_equal(r, data1d[..., r.s0:r.s0+20])
+
+
+def test_epoch_table_release(data1d):
+    table = pipeline.EpochTable(data1d.fs, lambda x: None)
+
+    # Partially captured epochs that are removed are returned to the pool.
+    table.add('A', 100, 5432, {})
+    table.feed(0, data1d[..., :1000])
+    buffer = table.buffers[table.index['A']]
+    table.remove('A')
+    assert pipeline._acquire_epoch(buffer.shape, buffer.dtype) is buffer
+    pipeline.release_epoch(buffer)
+
+    # Same for duplicates that were partially captured from prior samples.
+    table.add('B', 2000, 5432, {})
+    with pytest.raises(ValueError):
+        table.add('B', 100, 5432, {}, [(0, data1d[..., :1000])])
+    assert pipeline._acquire_epoch(buffer.shape, buffer.dtype) is buffer
+
+
 @pytest.mark.parametrize('data,', ['data1d', 'data2d'])
 def test_rms(fs, data, request):
     data = request.getfixturevalue(data)
@@ -3,10 +3,13 @@ import pytest
 from collections import Counter, deque
 
 import numpy as np
+import pandas as pd
 
 from psiaudio.calibration import FlatCalibration
 from psiaudio.pipeline import extract_epochs
-from psiaudio.queue import FIFOSignalQueue, InterleavedFIFOSignalQueue
+from psiaudio.queue import (
+    FIFOSignalQueue, InterleavedFIFOSignalQueue, RandomSignalQueue
+)
 from psiaudio.stim import Cos2EnvelopeFactory, ToneFactory
 
 rate = 76.0
@@ -393,6 +396,39 @@ def test_queue_continuous_tone(fs):
     assert conn.popleft()['t0'] == (samples * 2) / fs
 
 
+def test_queue_buffer_pool(fs):
+    samples = round(0.1 * fs)
+    queue, _, _, _, _ = make_queue(fs, 'FIFO', (1e3, 5e3), 1, duration=1)
+    expected = FIFOSignalQueue(fs=fs, with_pool=False)
+    for t in (make_tone(fs, 1e3, duration=1), make_tone(fs, 5e3, duration=1)):
+        expected.append(t, 1, max(isi - 1, 0))
+
+    w1 = queue.pop_buffer(samples)
+    assert np.all(w1 == expected.pop_buffer(samples))
+    queue.release_buffer(w1)
+
+    # The released buffer should be reused (and overwritten) by the next call.
+    w2 = queue.pop_buffer(samples)
+    assert w2 is w1
+    assert np.all(w2 == expected.pop_buffer(samples))
+
+    # Buffers of a different size are not reused.
+    queue.release_buffer(w2)
+    w3 = queue.pop_buffer(samples + 1)
+    assert w3 is not w2
+
+    # Buffers can't be released twice or be multidimensional.
+    with pytest.raises(ValueError):
+        queue.release_buffer(w2)
+    with pytest.raises(ValueError):
+        queue.release_buffer(np.empty((2, samples)))
+
+    # Releasing is a no-op when the pool is disabled.
+    w4 = expected.pop_buffer(samples)
+    expected.release_buffer(w4)
+    assert expected.pop_buffer(samples) is not w4
+
+
 def test_future_pause(fs):
     queue, conn, rem_conn, _, _ = make_queue(fs, 'FIFO', [1e3, 5e3], 100)
     queue.pop_buffer(1000)
@@ -472,6 +508,39 @@ def test_remove_keys_with_no_auto_decrement(fs):
         assert k not in counts
 
 
+def test_insert_key(fs):
+    frequencies = (500, 1e3, 2e3)
+    queue, conn, _, keys, tones = make_queue(fs, 'FIFO', frequencies, 1)
+    k = queue.insert(make_tone(fs, 4e3), 1)
+    assert queue.count_factories() == 4
+    assert queue.next_key() == k
+    queue.remove_key(k)
+    assert queue.next_key() == keys[0]
+    queue.remove_key(keys[1])
+    queue.pop_buffer(int(fs))
+    assert [c['key'] for c in conn] == [keys[0], keys[2]]
+
+
+def test_random_queue_seed(fs):
+    def get_frequencies(seed):
+        queue = RandomSignalQueue(fs=fs, seed=seed)
+        conn = deque()
+        queue.connect(conn.append, 'added')
+        for frequency in (500, 1e3, 2e3, 4e3, 8e3):
+            queue.append(make_tone(fs, frequency), 10, isi,
+                         metadata={'frequency': frequency})
+        queue.pop_buffer(int(fs * 0.5))
+        return [c['metadata']['frequency'] for c in conn]
+
+    frequencies = get_frequencies(1)
+    assert len(frequencies) > 10
+    assert frequencies == get_frequencies(1)
+    assert frequencies != get_frequencies(2)
+
+    # Sampling rate is still the first positional argument.
+    assert RandomSignalQueue(fs).fs == fs
+
+
 def test_get_closest_key(fs):
     frequencies = (500, 1e3, 2e3, 4e3, 8e3)
     queue, conn, _, keys, tones = make_queue(fs, 'FIFO', frequencies, 100)
@@ -550,3 +619,13 @@ def test_rebuffering(fs):
 
     # Make sure epochs 1 ... end are equal to epoch 0
     assert np.all(np.equal(epochs[:, [0]], epochs))
+
+
+def test_extend_broadcast(fs):
+    queue = FIFOSignalQueue(fs=fs)
+    keys = queue.extend([make_tone(fs), make_tone(fs)], pd.Series([2, 3]),
+                        np.array(isi), metadata={'x': 1})
+    assert [queue.remaining_trials(k) for k in keys] == [2, 3]
+
+    with pytest.raises(ValueError):
+        queue.extend([make_tone(fs), make_tone(fs)], [1, 2, 3])
@@ -1,5 +1,7 @@
 import pytest
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
 from numpy.testing import assert_array_almost_equal, assert_array_equal
@@ -65,6 +67,33 @@ def test_silence_factory(silence_fill_value):
     waveform = silence.next(100)
     assert_array_equal(waveform, expected)
 
+    # The buffer is shared between calls, so it must not be writeable.
+    assert not waveform.flags.writeable
+    assert_array_equal(silence.next(1000), np.full(1000, silence_fill_value))
+
+
+def test_fill_empty():
+    silence = stim.SilenceFactory()
+    assert silence.fill(np.empty(0)).shape == (0,)
+    with pytest.raises(ValueError):
+        silence.fill(np.empty(10), chunksize=0)
+
+    tone = stim.ToneFactory(fs=1000, frequency=100, level=1)
+    env = stim.Cos2EnvelopeFactory(fs=1000, duration=0.1, rise_time=0.01,
+                                   input_factory=tone)
+    assert env.fill(np.empty(0)).shape == (0,)
+
+
+def test_gate_factory_silence():
+    silence = stim.SilenceFactory(fill_value=1)
+    gate = stim.GateFactory(fs=1000, start_time=0.01, duration=0.02,
+                            input_factory=silence)
+    expected = np.zeros(50)
+    expected[10:30] = 1
+    assert_array_equal(gate.next(50), expected)
+    # The gate should not have modified the silence buffer.
+    assert_array_equal(silence.next(50), np.ones(50))
+
 
 def test_cos2envelope_shape():
     fs = 100e3
@@ -131,6 +160,16 @@ def test_cos2envelope_factory():
     assert_array_equal(w1, w2)
 
 
+def test_ramped_tone_broadcast():
+    fs = 100e3
+    frequency = np.array([[1e3], [2e3]])
+    actual = stim.ramped_tone(fs, frequency, 1, 0.01, rise_time=0.002)
+    assert actual.shape == (2, 1000)
+    for f, a in zip(frequency[:, 0], actual):
+        expected = stim.ramped_tone(fs, f, 1, 0.01, rise_time=0.002)
+        assert_array_equal(a, expected)
+
+
 @pytest.fixture(scope='module', params=[0.1e-3, 0.2e-3, 0.3e-3])
 def env_start_time(request):
     return request.param
@@ -240,6 +279,57 @@ def test_envelope(fs, env_window, env_duration, env_rise_time, chunksize,
                               n_chunks)
 
 
+def test_envelope_factory_cache(fs):
+    tone = stim.ToneFactory(fs, frequency=1e3, level=1)
+    factory = stim.Cos2EnvelopeFactory(fs, duration=5e-3, rise_time=0.5e-3,
+                                       input_factory=tone)
+    samples = factory.n_samples()
+    w1 = factory.next(samples)
+    factory.reset()
+    w2 = factory.next(samples)
+    assert_array_equal(w1, w2)
+    # The envelope fragment is reused on each trial.
+    assert len(factory.env_cache) == 1
+    env, = factory.env_cache.values()
+    assert not env.flags.writeable
+
+
+def test_envelope_float32(fs, env_window):
+    expected = stim.ramped_tone(fs, frequency=1e3, level=1, duration=0.1,
+                                rise_time=10e-3, window=env_window)
+    tone = stim.ToneFactory(fs, frequency=1e3, level=1, dtype=np.float32)
+    factory = stim.EnvelopeFactory(env_window, fs, duration=0.1,
+                                   rise_time=10e-3, input_factory=tone,
+                                   dtype=np.float32)
+    chunks = [factory.next(1000) for i in range(len(expected) // 1000 + 1)]
+    actual = np.concatenate(chunks)[:len(expected)]
+    assert actual.dtype == np.float32
+    np.testing.assert_allclose(actual, expected, atol=1e-5)
+
+    silence = stim.SilenceFactory(dtype=np.float32)
+    assert silence.next(100).dtype == np.float32
+
+
+def test_envelope_factory_get_envelope(fs, env_window):
+    factory = stim.EnvelopeFactory(env_window, fs, duration=0.1,
+                                   rise_time=10e-3, start_time=5e-3,
+                                   input_factory=stim.SilenceFactory())
+    expected = stim.envelope(env_window, fs, duration=0.1, rise_time=10e-3,
+                             start_time=5e-3)
+    n = len(expected)
+
+    # Since each fragment depends only on the offset, sections can be filled
+    # in any order (including in parallel).
+    actual = np.full(n, np.nan)
+    chunksize = 1000
+    offsets = range(0, n, chunksize)
+    def fill(o):
+        factory.get_envelope(o, min(chunksize, n - o), out=actual[o:])
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(fill, offsets))
+    assert_array_equal(actual, expected)
+
+
 @pytest.fixture(scope='module', params=[0, 0.2, 1.0])
 def square_wave_duty_cycle(request):
     return request.param